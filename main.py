@@ -1,25 +1,64 @@
+import os
 import streamlit as st
 import sqlite3
 import hashlib
-import requests
+import asyncio
+import aiohttp
 import re
+import heapq
 import time
-from bs4 import BeautifulSoup
-from sentence_transformers import SentenceTransformer, util
+import threading
+import numpy as np
+import torch
+import faiss
+import onnxruntime
+from selectolax.parser import HTMLParser
+from sentence_transformers import SentenceTransformer
 from duckduckgo_search import DDGS
-import pypdf
+import pymupdf
 import docx
 
 # --- CONFIGURATION ---
 DATABASE_FILE = "submission_archive_v2.db"
+# Scraped pages are re-fetched after 24 hours
+WEB_CACHE_TTL = 24 * 60 * 60
 # We use a lightweight BERT model optimized for speed and semantic similarity
 MODEL_NAME = 'all-MiniLM-L6-v2'
+# Dynamically quantized int8 export shipped with the model, used for CPU inference
+ONNX_MODEL_FILE = 'onnx/model_qint8_avx512_vnni.onnx'
+# Long documents are compared as overlapping windows that fit the model's 256-token limit
+CHUNK_TOKENS = 200
+CHUNK_STRIDE = 150
+# Past this archive size, candidates come from an HNSW index instead of a full scan
+INDEX_FILE = "submission_archive_v2.faiss"
+ANN_MIN_DOCS = 10_000
+ANN_TOP_K = 50
+HNSW_M = 32
 
 
 # --- LOAD AI MODEL (Cached for Speed) ---
 @st.cache_resource
 def load_model():
-    return SentenceTransformer(MODEL_NAME)
+    # Use every core for PyTorch ops instead of the conservative default
+    torch.set_num_threads(os.cpu_count())
+
+    if torch.cuda.is_available():
+        # FP16 halves memory traffic; drift is negligible at our similarity thresholds
+        # Native scaled-dot-product attention gives fused kernels without BetterTransformer
+        model = SentenceTransformer(MODEL_NAME, device='cuda',
+                                    model_kwargs={'attn_implementation': 'sdpa'}).half()
+        # Fuse kernels; dynamic shapes cover every batch size and sequence length,
+        # and no CUDA graphs since Streamlit sessions share this model across threads
+        model[0].auto_model = torch.compile(model[0].auto_model, dynamic=True)
+        return model
+
+    # No GPU: run the int8 ONNX graph, 2-4x faster than FP32 PyTorch on CPU
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = os.cpu_count()
+    return SentenceTransformer(MODEL_NAME, backend='onnx',
+                               model_kwargs={'file_name': ONNX_MODEL_FILE,
+                                             'provider': 'CPUExecutionProvider',
+                                             'session_options': session_options})
 
 
 model = load_model()
@@ -28,11 +67,9 @@ model = load_model()
 # --- FILE PARSING MODULE ---
 def extract_text_from_pdf(file):
     try:
-        pdf_reader = pypdf.PdfReader(file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        with pymupdf.open(stream=file.read(), filetype="pdf") as doc:
+            # Single join over all pages, no quadratic string accumulation
+            return "\n".join([page.get_text() for page in doc])
     except Exception as e:
         return str(e)
 
@@ -46,148 +83,455 @@ def extract_text_from_docx(file):
 
 
 # --- DATABASE MANAGEMENT ---
-def init_db():
-    conn = sqlite3.connect(DATABASE_FILE)
+@st.cache_resource
+def get_conn():
+    """One connection shared by every rerun; sqlite3 caches its prepared statements."""
+    conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+    # WAL lets readers proceed while a paper is being archived
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@st.cache_resource
+def get_db_lock():
+    """Serializes every use of the shared connection so sessions never see each other's transactions."""
+    return threading.Lock()
+
+
+def init_db(conn):
+    with get_db_lock():
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS submissions
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                      student_name TEXT, 
+                      filename TEXT,
+                      content TEXT, 
+                      content_hash TEXT UNIQUE,
+                      embedding BLOB)''')
+        # Archives created before embeddings were cached need the extra column
+        columns = [row[1] for row in c.execute("PRAGMA table_info(submissions)")]
+        if 'embedding' not in columns:
+            c.execute("ALTER TABLE submissions ADD COLUMN embedding BLOB")
+        # Scraped pages are shared across submissions, cache them with their embeddings
+        c.execute('''CREATE TABLE IF NOT EXISTS web_cache
+                     (url_hash TEXT PRIMARY KEY,
+                      fetched_at INTEGER,
+                      content TEXT,
+                      embedding BLOB)''')
+
+        # v1: embeddings are stored as FP16 instead of FP32
+        if c.execute("PRAGMA user_version").fetchone()[0] < 1:
+            c.execute("SELECT id, embedding FROM submissions WHERE embedding IS NOT NULL")
+            c.executemany("UPDATE submissions SET embedding = ? WHERE id = ?",
+                          [(np.frombuffer(blob, dtype=np.float32).astype(np.float16).tobytes(), row_id)
+                           for row_id, blob in c.fetchall()])
+            c.execute("DELETE FROM web_cache")
+            c.execute("PRAGMA user_version = 1")
+        conn.commit()
+
+
+def save_to_db(conn, name, filename, content):
+    # Duplicates are rejected before any transformer work is spent on them
+    if find_exact_match(conn, content):
+        return False
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS submissions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                  student_name TEXT, 
-                  filename TEXT,
-                  content TEXT, 
-                  content_hash TEXT UNIQUE)''')
-    conn.commit()
-    conn.close()
-
-
-def save_to_db(name, filename, content):
-    conn = sqlite3.connect(DATABASE_FILE)
+    content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
+    # Embed once at archive time so later checks never re-run BERT on this paper
+    embedding = encode_documents([content])[0]
+    with get_db_lock():
+        try:
+            c.execute("INSERT INTO submissions (student_name, filename, content, content_hash, embedding) VALUES (?, ?, ?, ?, ?)",
+                      (name, filename, content, content_hash, embedding_to_blob(embedding)))
+            conn.commit()
+            return True
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            return False
+
+
+def clear_db(conn):
+    """Empties the archive and web cache in place, so other sessions keep a working connection."""
+    with get_db_lock():
+        c = conn.cursor()
+        c.execute("DELETE FROM submissions")
+        c.execute("DELETE FROM web_cache")
+        # sqlite_sequence is left alone: AUTOINCREMENT ids must never be reused,
+        # since the ANN index identifies archive rows by id
+        conn.commit()
+
+
+def embedding_to_blob(embedding):
+    # Raw FP16 bytes: half the size of FP32, cosine drift is negligible
+    return embedding.cpu().numpy().astype(np.float16).tobytes()
+
+
+def blob_to_embedding(blob):
+    """Decodes a stored (n_chunks, dim) chunk-embedding matrix into FP32."""
+    dim = model.get_sentence_embedding_dimension()
+    return torch.from_numpy(np.frombuffer(blob, dtype=np.float16).reshape(-1, dim).astype(np.float32))
+
+
+def find_exact_match(conn, content):
+    """Returns (student_name, filename) of an archived paper with identical content, if any."""
     c = conn.cursor()
     content_hash = hashlib.md5(content.encode('utf-8')).hexdigest()
-    try:
-        c.execute("INSERT INTO submissions (student_name, filename, content, content_hash) VALUES (?, ?, ?, ?)",
-                  (name, filename, content, content_hash))
+    with get_db_lock():
+        c.execute("SELECT student_name, filename FROM submissions WHERE content_hash = ?", (content_hash,))
+        match = c.fetchone()
+    return match
+
+
+def backfill_embeddings(conn):
+    """Embeds rows archived before embeddings were cached (encoding happens outside the lock)."""
+    c = conn.cursor()
+    with get_db_lock():
+        c.execute("SELECT id, content FROM submissions WHERE embedding IS NULL")
+        missing = c.fetchall()
+    if not missing:
+        return
+    embeddings = encode_documents([content for _, content in missing])
+    with get_db_lock():
+        c.executemany("UPDATE submissions SET embedding = ? WHERE id = ?",
+                      [(embedding_to_blob(emb), row_id) for emb, (row_id, _) in zip(embeddings, missing)])
         conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    fetch_internal_db.clear()
+
+
+@st.cache_resource(ttl=60)
+def fetch_internal_db(_conn):
+    """
+    Returns row ids, (student_name, filename) rows and a normalized (n_chunks, dim)
+    embedding matrix per row. Shared across sessions without copying, so never mutate the result.
+    """
+    c = _conn.cursor()
+    with get_db_lock():
+        c.execute("SELECT id, student_name, filename, embedding FROM submissions ORDER BY id")
+        data = c.fetchall()
+
+    row_ids = [row_id for row_id, _, _, _ in data]
+    records = [(name, filename) for _, name, filename, _ in data]
+    # Vectors are stored unit-normalized, so they can be dotted with the query as-is
+    embeddings = [blob_to_embedding(blob) for _, _, _, blob in data]
+    return row_ids, records, embeddings
 
 
-def fetch_internal_db():
-    conn = sqlite3.connect(DATABASE_FILE)
+def load_web_cache(conn, urls):
+    """Returns {url: (content, embedding)} for every URL scraped within the cache TTL."""
+    url_by_hash = {hashlib.md5(url.encode('utf-8')).hexdigest(): url for url in urls}
     c = conn.cursor()
-    c.execute("SELECT student_name, filename, content FROM submissions")
-    data = c.fetchall()
-    conn.close()
-    return data
+    placeholders = ", ".join("?" * len(url_by_hash))
+    with get_db_lock():
+        c.execute(f"SELECT url_hash, content, embedding FROM web_cache WHERE url_hash IN ({placeholders}) AND fetched_at >= ?",
+                  (*url_by_hash, int(time.time()) - WEB_CACHE_TTL))
+        data = c.fetchall()
+    return {url_by_hash[url_hash]: (content, blob_to_embedding(blob)) for url_hash, content, blob in data}
+
+
+def save_web_cache(conn, sources):
+    c = conn.cursor()
+    fetched_at = int(time.time())
+    with get_db_lock():
+        # Evict expired pages so the cache does not grow without bound
+        c.execute("DELETE FROM web_cache WHERE fetched_at < ?", (fetched_at - WEB_CACHE_TTL,))
+        c.executemany("INSERT OR REPLACE INTO web_cache (url_hash, fetched_at, content, embedding) VALUES (?, ?, ?, ?)",
+                      [(hashlib.md5(source['source'].encode('utf-8')).hexdigest(), fetched_at, source['content'],
+                        embedding_to_blob(source['embedding'])) for source in sources])
+        conn.commit()
 
 
 # --- RIGOROUS SEARCH ENGINE ---
-def scrape_url_content(url):
+# User-Agent is crucial to avoid being blocked by websites
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+MAX_CONCURRENT_SCRAPES = 10
+RESULTS_PER_QUERY = 2
+MAX_PAGE_BYTES = 200_000
+# Sentence boundaries, skipping abbreviations like "e.g." and "Mr."
+_SENT_SPLIT = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s')
+
+
+def extract_visible_text(html):
+    """Strips the HTML and returns the main text content."""
+    tree = HTMLParser(html)
+
+    # Kill all script and style elements
+    for tag in tree.css('script, style'):
+        tag.decompose()
+
+    text = tree.body.text(separator='\n') if tree.body else ''
+    # Break into lines and remove leading and trailing space on each
+    lines = (line.strip() for line in text.splitlines())
+    # Break multi-headlines into a line each
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text = '\n'.join(chunk for chunk in chunks if chunk)
+    return text[:10000]  # Limit to first 10k chars to save memory
+
+
+async def scrape_url_content(session, url):
     """Visits a URL and extracts the main text content."""
     try:
-        # User-Agent is crucial to avoid being blocked by websites
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(url, headers=headers, timeout=5)
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # Kill all script and style elements
-        for script in soup(["script", "style"]):
-            script.extract()
-
-        text = soup.get_text()
-        # Break into lines and remove leading and trailing space on each
-        lines = (line.strip() for line in text.splitlines())
-        # Break multi-headlines into a line each
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = '\n'.join(chunk for chunk in chunks if chunk)
-        return text[:10000]  # Limit to first 10k chars to save memory
-    except:
+        async with session.get(url, headers=HEADERS, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            # Stop downloading after the cap, we only keep the first 10k chars of text anyway
+            html = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                html.extend(chunk)
+                if len(html) >= MAX_PAGE_BYTES:
+                    break
+        # Parsing is CPU-bound, keep it off the event loop
+        return await asyncio.to_thread(extract_visible_text, bytes(html[:MAX_PAGE_BYTES]))
+    except Exception:
         return ""
 
 
-def deep_web_search(text, num_queries=3):
+def search_duckduckgo(query):
+    """Returns the top DuckDuckGo hits for a single query."""
+    with DDGS() as ddgs:
+        return list(ddgs.text(query[:200], max_results=RESULTS_PER_QUERY))
+
+
+async def search_and_scrape(conn, queries, on_progress):
+    """
+    Producer/consumer pipeline: every query's hits are queued as soon as
+    DuckDuckGo answers, so scraping overlaps the searches still in flight.
+    Returns (cached_sources, fresh_sources); fresh ones still need embedding.
+    """
+    queue = asyncio.Queue()
+    seen_urls = set()
+    cached_data, fresh_data = [], []
+    done = 0
+
+    async def produce(query):
+        try:
+            results = await asyncio.to_thread(search_duckduckgo, query)
+            hrefs = [res['href'] for res in results]
+        except Exception:
+            return
+        # Deduplicate URLs
+        new_urls = [url for url in dict.fromkeys(hrefs) if url not in seen_urls]
+        seen_urls.update(new_urls)
+        if not new_urls:
+            return
+        # Popular pages are reused from the cache instead of being re-scraped and re-embedded;
+        # one lookup per query, off the event loop
+        cached = await asyncio.to_thread(load_web_cache, conn, new_urls)
+        for url in new_urls:
+            await queue.put((url, cached.get(url)))
+
+    async def produce_all():
+        await asyncio.gather(*(produce(query) for query in queries))
+        for _ in range(MAX_CONCURRENT_SCRAPES):
+            await queue.put(None)
+
+    async def consume(session):
+        nonlocal done
+        while (item := await queue.get()) is not None:
+            url, cached = item
+            if cached:
+                content, embedding = cached
+                cached_data.append({'source': url, 'content': content, 'type': 'Web', 'embedding': embedding})
+            else:
+                content = await scrape_url_content(session, url)
+                if content:
+                    fresh_data.append({'source': url, 'content': content, 'type': 'Web'})
+            done += 1
+            on_progress(done, url)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(produce_all(), *(consume(session) for _ in range(MAX_CONCURRENT_SCRAPES)))
+
+    return cached_data, fresh_data
+
+
+def deep_web_search(conn, text, num_queries=3):
     """
     1. Extracts search terms.
     2. Searches DuckDuckGo.
-    3. VISITS the top results and scrapes content.
+    3. VISITS the top results and scrapes content, while later searches are still running.
     """
     # Create search queries from the most unique sentences
-    sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', text)
-    long_sentences = sorted([s for s in sentences if len(s) > 40], key=len, reverse=True)[:num_queries]
+    sentences = _SENT_SPLIT.split(text)
+    long_sentences = heapq.nlargest(num_queries, (s for s in sentences if len(s) > 40), key=len)
+    if not long_sentences:
+        return []
 
-    potential_sources = []
+    # Progress bar for scraping, sized for the most URLs the searches can return
+    progress_text = "Searching and visiting detected websites..."
+    my_bar = st.progress(0, text=progress_text)
+    max_urls = len(long_sentences) * RESULTS_PER_QUERY
 
-    with DDGS() as ddgs:
-        for query in long_sentences:
-            try:
-                results = list(ddgs.text(query[:200], max_results=2))
-                for res in results:
-                    potential_sources.append(res['href'])
-                time.sleep(0.5)
-            except:
-                pass
+    def on_progress(done, url):
+        my_bar.progress(min(done / max_urls, 1.0), text=f"Scraped {url}...")
 
-    # Deduplicate URLs
-    unique_urls = list(set(potential_sources))
-    scraped_data = []
+    scraped_data, fresh_data = asyncio.run(search_and_scrape(conn, long_sentences, on_progress))
 
-    # Progress bar for scraping
-    if unique_urls:
-        progress_text = "Visiting detected websites..."
-        my_bar = st.progress(0, text=progress_text)
+    my_bar.empty()
 
-        for i, url in enumerate(unique_urls):
-            content = scrape_url_content(url)
-            if content:
-                scraped_data.append({'source': url, 'content': content, 'type': 'Web'})
-            my_bar.progress((i + 1) / len(unique_urls), text=f"Scraping {url}...")
+    if fresh_data:
+        embeddings = encode_documents([source['content'] for source in fresh_data])
+        for source, embedding in zip(fresh_data, embeddings):
+            source['embedding'] = embedding
+        save_web_cache(conn, fresh_data)
 
-        my_bar.empty()
-
-    return scraped_data
+    return scraped_data + fresh_data
 
 
 # --- AI SIMILARITY ENGINE ---
-def compute_semantic_similarity(source_text, target_text):
+def encode_corpus(texts, batch_size=32):
+    """
+    Smart batching: sorts texts by token length so every mini-batch holds
+    similar lengths and little compute is wasted on [PAD] tokens,
+    then restores the original order of the embeddings.
+    """
+    lengths = model.tokenizer(texts, truncation=True, max_length=model.max_seq_length,
+                              return_length=True)['length']
+    order = torch.argsort(torch.tensor(lengths), descending=True)
+
+    batches = []
+    for start in range(0, len(texts), batch_size):
+        batch = [texts[i] for i in order[start:start + batch_size].tolist()]
+        batches.append(model.encode(batch, batch_size=batch_size, normalize_embeddings=True,
+                                    convert_to_tensor=True, show_progress_bar=False))
+    embeddings = torch.cat(batches)
+
+    # Invert the permutation so row i matches texts[i] again
+    restored = torch.empty_like(embeddings)
+    restored[order.to(embeddings.device)] = embeddings
+    return restored
+
+
+@st.cache_resource
+def warm_up_encoder():
+    """Compiles the GPU encoder on a full-size batch so the first user's check doesn't pay for it."""
+    if torch.cuda.is_available():
+        encode_corpus(["warmup " * model.max_seq_length] * 32)
+
+
+def chunk_text(text, size=CHUNK_TOKENS, stride=CHUNK_STRIDE):
+    """Splits text into overlapping windows of `size` tokens, `stride` tokens apart."""
+    tokens = model.tokenizer(text, add_special_tokens=False)['input_ids']
+    last_start = max(len(tokens) - (size - stride), 1)
+    return [model.tokenizer.decode(tokens[i:i + size]) for i in range(0, last_start, stride)]
+
+
+def encode_documents(texts):
+    """
+    Sliding window: encodes every chunk of every document in one batched pass,
+    returning a normalized (n_chunks, dim) FP32 CPU matrix per document.
+    """
+    chunks = [chunk_text(text) for text in texts]
+    embeddings = encode_corpus([chunk for doc_chunks in chunks for chunk in doc_chunks]).float().cpu()
+    return list(torch.split(embeddings, [len(doc_chunks) for doc_chunks in chunks]))
+
+
+@st.cache_resource(max_entries=8)
+def encode_query(text):
     """
-    Uses BERT embeddings to find similarity.
+    Normalized (n_chunks, dim) embeddings of the submission being checked.
+    Cached so re-running a check on the same file does not re-encode it.
+    """
+    return encode_corpus(chunk_text(text))
+
+
+def score_against_corpus(query_embeddings, corpus_embeddings):
+    """
+    Uses BERT embeddings to find similarity between the query and every corpus document.
     This detects paraphrasing, not just exact word matches.
+    A document's score is its best-matching chunk pair, so copying a single
+    paragraph of a long essay is still caught.
+    Corpus embeddings are precomputed (archive and web cache), so nothing is encoded here.
     """
-    # Split texts into chunks to handle long documents (BERT limit is usually 512 tokens)
-    # For simplicity here, we truncate or treat as one block depending on length.
-    # In a full production system, you'd use a sliding window.
+    if not corpus_embeddings:
+        return []
+
+    # Cached vectors are FP32 on CPU, match the encoder's device and precision
+    chunk_matrix = torch.cat(corpus_embeddings).to(query_embeddings.device, query_embeddings.dtype)
+    doc_ids = torch.repeat_interleave(torch.arange(len(corpus_embeddings)),
+                                      torch.tensor([len(emb) for emb in corpus_embeddings]))
 
-    embedding_1 = model.encode(source_text, convert_to_tensor=True)
-    embedding_2 = model.encode(target_text, convert_to_tensor=True)
+    # Normalized embeddings make cosine similarity a plain dot product
+    chunk_scores = (query_embeddings @ chunk_matrix.T).max(dim=0).values
+    scores = torch.full((len(corpus_embeddings),), -1.0, dtype=chunk_scores.dtype, device=chunk_scores.device)
+    scores = scores.scatter_reduce(0, doc_ids.to(chunk_scores.device), chunk_scores, reduce='amax')
+    # FP16 rounding can push identical chunks just past 1.0, which st.progress rejects
+    return scores.clamp_(max=1.0).cpu().tolist()
 
-    score = util.pytorch_cos_sim(embedding_1, embedding_2)
-    return score.item()
+
+# --- ARCHIVE INDEX (Approximate Nearest Neighbours) ---
+@st.cache_resource
+def load_archive_index():
+    """HNSW index over archive chunks, each stored under the id of the submissions row it came from."""
+    if os.path.exists(INDEX_FILE):
+        return faiss.read_index(INDEX_FILE)
+    return faiss.IndexIDMap(faiss.IndexHNSWFlat(model.get_sentence_embedding_dimension(), HNSW_M,
+                                                faiss.METRIC_INNER_PRODUCT))
+
+
+@st.cache_resource
+def get_index_lock():
+    return threading.Lock()
+
+
+def sync_archive_index(row_ids, archive_embeddings):
+    """Adds archive rows missing from the index and persists it; rebuilds if indexed rows disappeared."""
+    with get_index_lock():
+        index = load_archive_index()
+        # Runs on every rerun: skip the full id scan when the newest row and chunk count already match
+        n_chunks = sum(len(emb) for emb in archive_embeddings)
+        if index.ntotal == n_chunks and index.ntotal and index.id_map.at(index.ntotal - 1) == row_ids[-1]:
+            return
+        indexed = set(faiss.vector_to_array(index.id_map).tolist())
+        if not indexed <= set(row_ids):
+            index.reset()
+            indexed = set()
+
+        new_rows = [(row_id, emb) for row_id, emb in zip(row_ids, archive_embeddings) if row_id not in indexed]
+        if not new_rows:
+            return
+        chunk_ids = np.repeat([row_id for row_id, _ in new_rows], [len(emb) for _, emb in new_rows])
+        index.add_with_ids(torch.cat([emb for _, emb in new_rows]).numpy(), chunk_ids.astype(np.int64))
+        faiss.write_index(index, INDEX_FILE)
+
+
+def reset_archive_index():
+    with get_index_lock():
+        load_archive_index().reset()
+        if os.path.exists(INDEX_FILE):
+            os.remove(INDEX_FILE)
+
+
+def search_archive_index(query_embeddings, k=ANN_TOP_K):
+    """Returns the submissions row ids owning the top-k nearest chunks of any query chunk."""
+    with get_index_lock():
+        _, neighbours = load_archive_index().search(query_embeddings.float().cpu().numpy(), k)
+    return set(neighbours[neighbours >= 0].tolist())
 
 
 # --- FRONTEND ---
 def main():
     st.set_page_config(page_title="OpenPlag PRO", layout="wide")
+    warm_up_encoder()
 
     st.title("🦅 OpenPlag PRO")
     st.markdown("### Deep Learning Powered Plagiarism Detection")
     st.info("Supported: .txt, .pdf, .docx | Checks: Local Database + Live Internet")
 
-    init_db()
+    conn = get_conn()
+    init_db(conn)
 
     with st.sidebar:
         st.header("Admin Panel")
-        db_data = fetch_internal_db()
-        st.metric("Repository Size", f"{len(db_data)} Docs")
+        backfill_embeddings(conn)
+        db_row_ids, db_records, db_embeddings = fetch_internal_db(conn)
+        # Keep the index current at load time, never inside a check
+        if len(db_row_ids) > ANN_MIN_DOCS:
+            sync_archive_index(db_row_ids, db_embeddings)
+        st.metric("Repository Size", f"{len(db_records)} Docs")
         if st.button("Refresh / Clear DB"):
-            import os
-            try:
-                os.remove(DATABASE_FILE)
-                st.rerun()
-            except:
-                pass
+            clear_db(conn)
+            fetch_internal_db.clear()
+            reset_archive_index()
+            st.rerun()
 
     # --- INPUT SECTION ---
     col1, col2 = st.columns([1, 2])
@@ -221,25 +565,44 @@ def main():
                 st.divider()
                 st.subheader("3. Analysis Report")
 
-                # A. INTERNAL CHECK
-                internal_matches = []
-                for db_name, db_file, db_content in db_data:
-                    sim_score = compute_semantic_similarity(extracted_text, db_content)
-                    if sim_score > 0.4:  # BERT threshold
-                        internal_matches.append({'source': f"Internal: {db_name} ({db_file})", 'score': sim_score})
+                # A. EXACT COPY FAST PATH (no archive scoring needed)
+                exact_match = find_exact_match(conn, extracted_text)
 
-                # B. EXTERNAL CHECK
-                web_matches = []
-                scraped_sources = deep_web_search(extracted_text)
-
-                for source in scraped_sources:
-                    sim_score = compute_semantic_similarity(extracted_text, source['content'])
-                    if sim_score > 0.3:  # Web content is noisier, lower threshold
-                        web_matches.append({'source': source['source'], 'score': sim_score})
+                # B. GATHER CANDIDATES (Local Database + Live Internet)
+                query_embeddings = encode_query(extracted_text)
+                if exact_match:
+                    archive_ids = []
+                elif len(db_records) > ANN_MIN_DOCS:
+                    candidate_ids = search_archive_index(query_embeddings)
+                    archive_ids = [i for i, row_id in enumerate(db_row_ids) if row_id in candidate_ids]
+                else:
+                    archive_ids = range(len(db_records))
+                archive_records = [db_records[i] for i in archive_ids]
+                archive_embeddings = [db_embeddings[i] for i in archive_ids]
+
+                scraped_sources = deep_web_search(conn, extracted_text)
+                web_embeddings = [source['embedding'] for source in scraped_sources]
+
+                # C. SCORE EVERYTHING IN ONE MATMUL (all embeddings are precomputed)
+                scores = score_against_corpus(query_embeddings, archive_embeddings + web_embeddings)
+                internal_scores = scores[:len(archive_records)]
+                web_scores = scores[len(archive_records):]
+
+                internal_matches = [{'source': f"Internal: {db_name} ({db_file})", 'score': sim_score}
+                                    for (db_name, db_file), sim_score in zip(archive_records, internal_scores)
+                                    if sim_score > 0.4]  # BERT threshold
+                if exact_match:
+                    db_name, db_file = exact_match
+                    internal_matches.append({'source': f"Internal: {db_name} ({db_file}) - exact copy", 'score': 1.0})
+
+                # Still check the web: the archived paper may itself have been copied
+                web_matches = [{'source': source['source'], 'score': sim_score}
+                               for source, sim_score in zip(scraped_sources, web_scores)
+                               if sim_score > 0.3]  # Web content is noisier, lower threshold
 
-                # C. RESULTS DISPLAY
                 all_matches = sorted(internal_matches + web_matches, key=lambda x: x['score'], reverse=True)
 
+                # D. RESULTS DISPLAY
                 if not all_matches:
                     st.success("✅ Clean! No significant similarity found.")
                     max_score = 0
@@ -254,9 +617,10 @@ def main():
                     for match in all_matches[:5]:  # Show top 5
                         st.progress(match['score'], text=f"{match['score'] * 100:.1f}% - {match['source']}")
 
-                # D. SAVE OPTION
+                # E. SAVE OPTION
                 if st.button("💾 Archive this paper"):
-                    if save_to_db(student_name, uploaded_file.name, extracted_text):
+                    if save_to_db(conn, student_name, uploaded_file.name, extracted_text):
+                        fetch_internal_db.clear()
                         st.success("Archived to repository.")
                     else:
                         st.warning("Already exists in repository.")